@@ -1,16 +1,26 @@
+import math
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, StringIO
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file
+from flask import (
+    Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, Response,
+    make_response, session,
+)
+from flask_caching import Cache
 from werkzeug.utils import secure_filename
 
 from sqlalchemy import (
     create_engine, MetaData, Table, Column, Integer, String, Float,
-    ForeignKey, func, select, insert, update, delete
+    ForeignKey, Index, event, func, or_, select, insert, update, delete, bindparam, case, desc, values,
+    column,
 )
 from sqlalchemy.engine import Engine
+import numpy as np
 import pandas as pd
+import xlsxwriter
 
 # --------------------------------------------------------------------
 # Configuração de banco: Postgres em produção, SQLite em desenvolvimento
@@ -21,10 +31,37 @@ UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "uploads")
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.secret_key = os.environ.get("SECRET_KEY", "metrifypremium-secret")
+# SimpleCache é por processo; com vários workers use CACHE_TYPE=RedisCache + CACHE_REDIS_URL
+app.config["CACHE_TYPE"] = os.environ.get("CACHE_TYPE", "SimpleCache")
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+app.config["CACHE_DEFAULT_TIMEOUT"] = 300
+cache = Cache(app)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-engine: Engine = create_engine(DATABASE_URL, future=True)
+engine_kwargs = {"future": True, "pool_pre_ping": True}
+if DATABASE_URL.startswith("sqlite"):
+    # a conexão também é usada pelas threads de importação
+    engine_kwargs["connect_args"] = {"check_same_thread": False}
+else:
+    engine_kwargs.update(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 20)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_recycle=1800,
+    )
+engine: Engine = create_engine(DATABASE_URL, **engine_kwargs)
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _registro):
+        # WAL + synchronous=NORMAL: não faz fsync a cada transação e leitores não bloqueiam a escrita
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
 metadata = MetaData()
 
 # --------------------------------------------------------------------
@@ -79,9 +116,29 @@ configuracoes = Table(
     Column("despesas_percent", Float, nullable=False, server_default="0"),
 )
 
+# Índices para os joins/agrupamentos por produto, a lista de lotes, a busca por nome
+# e a listagem de vendas por data. produtos.sku já tem índice por causa do unique=True.
+Index("ix_produtos_nome", produtos.c.nome)
+# no Postgres cobre os agregados do dashboard/relatório (index-only scan por produto)
+Index(
+    "ix_vendas_produto_cobertura",
+    vendas.c.produto_id,
+    postgresql_include=["quantidade", "receita_total", "custo_total", "margem_contribuicao"],
+)
+Index("ix_vendas_lote_importacao", vendas.c.lote_importacao)
+# data_venda é texto ISO 8601 (ordem alfabética = ordem cronológica)
+Index("ix_vendas_data_venda", vendas.c.data_venda, vendas.c.id)
+
+# Comando das importações: montado uma vez, só os parâmetros mudam a cada execução
+INSERT_VENDA = insert(vendas)
+
 def init_db():
     """Cria as tabelas se não existirem e garante 1 linha em configuracoes."""
     metadata.create_all(engine)
+    # create_all não cria índices novos em tabelas que já existem
+    for tabela in metadata.sorted_tables:
+        for indice in tabela.indexes:
+            indice.create(engine, checkfirst=True)
     with engine.begin() as conn:
         row = conn.execute(
             select(configuracoes.c.id).limit(1)
@@ -101,272 +158,341 @@ MESES_PT = {
     "novembro": 11, "dezembro": 12,
 }
 
-def parse_data_venda(texto):
-    if isinstance(texto, datetime):
-        return texto
-    if not isinstance(texto, str) or not texto.strip():
-        return None
-    try:
-        partes = texto.split()
-        dia = int(partes[0])
-        mes_nome = partes[2].lower()
-        ano = int(partes[4])
-        hora_min = partes[5]
-        hora, minuto = hora_min.split(":")
-        return datetime(ano, MESES_PT[mes_nome], int(dia), int(hora), int(minuto))
-    except Exception:
-        return None
+
+_DATA_VENDA_RE = r"^\s*(\d{1,2})\s+de\s+(\S+)\s+de\s+(\d{4})\s+(\d{1,2}):(\d{2})"
+
+
+def parse_data_venda(serie):
+    """Converte a coluna "Data da venda" do ML ('19 de novembro de 2025 15:30 hs.') de uma vez (NaT se inválida)."""
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie
+    # vendas do mesmo pedido repetem o horário: converte só os valores distintos
+    # (vazios ficam com código -1 e viram NaT no reindex do final)
+    codigos, unicos = pd.factorize(serie)
+    valores = pd.Series(unicos, dtype=object)
+    partes = valores.astype(str).str.lower().str.extract(_DATA_VENDA_RE)
+    datas = pd.to_datetime(
+        pd.DataFrame({
+            "year": pd.to_numeric(partes[2]),
+            "month": partes[1].map(MESES_PT),
+            "day": pd.to_numeric(partes[0]),
+            "hour": pd.to_numeric(partes[3]),
+            "minute": pd.to_numeric(partes[4]),
+        }),
+        errors="coerce",
+    )
+    # só o que não casou com o texto do ML é inspecionado: células que o Excel já entregou como data
+    faltando = valores[datas.isna()]
+    ja_datas = faltando[faltando.map(lambda v: isinstance(v, datetime))]
+    if not ja_datas.empty:
+        datas[ja_datas.index] = pd.to_datetime(ja_datas)
+    return datas.reindex(codigos).set_axis(serie.index)
 
 # --------------------------------------------------------------------
 # Importação de vendas do Mercado Livre
 # --------------------------------------------------------------------
+# únicas colunas do relatório "Vendas BR" usadas na importação
+COLUNAS_ML = {"N.º de venda", "Data da venda", "Unidades", "Total (BRL)", "SKU", "Título do anúncio"}
+# sem estas não há como gravar a venda; SKU e título podem faltar (a linha conta como sem SKU/Título)
+COLUNAS_ML_OBRIGATORIAS = ("N.º de venda", "Data da venda", "Unidades", "Total (BRL)")
+
+
 def importar_vendas_ml(caminho_arquivo, engine: Engine):
     lote_id = datetime.now().isoformat(timespec="seconds")
 
     df = pd.read_excel(
         caminho_arquivo,
         sheet_name="Vendas BR",
-        header=5
+        header=5,
+        engine="calamine",
+        usecols=lambda c: c in COLUNAS_ML,
+        dtype={"N.º de venda": "string", "SKU": "string", "Título do anúncio": "string"},
     )
-    if "N.º de venda" not in df.columns:
-        raise ValueError("Planilha não está no formato esperado: coluna 'N.º de venda' não encontrada.")
-
-    df = df[df["N.º de venda"].notna()]
+    faltando = [c for c in COLUNAS_ML_OBRIGATORIAS if c not in df.columns]
+    if faltando:
+        raise ValueError(
+            "Planilha não está no formato esperado: coluna(s) "
+            + ", ".join(f"'{c}'" for c in faltando) + " não encontrada(s)."
+        )
 
-    vendas_importadas = 0
-    vendas_sem_sku = 0
-    vendas_sem_produto = 0
+    df = df.dropna(subset=["N.º de venda"])
 
     with engine.begin() as conn:
-        for _, row in df.iterrows():
-            sku = str(row.get("SKU") or "").strip()
-            titulo = str(row.get("Título do anúncio") or "").strip()
-
-            produto_row = None
-
-            if sku:
-                produto_row = conn.execute(
-                    select(produtos.c.id, produtos.c.custo_unitario)
-                    .where(produtos.c.sku == sku)
-                ).mappings().first()
-            else:
-                # tenta pelo nome do produto = título do anúncio
-                if titulo:
-                    produto_row = conn.execute(
-                        select(produtos.c.id, produtos.c.custo_unitario)
-                        .where(produtos.c.nome == titulo)
-                    ).mappings().first()
-
-            if not sku and not produto_row:
-                vendas_sem_sku += 1
-                continue
-
-            if not produto_row:
-                vendas_sem_produto += 1
-                continue
-
-            produto_id = produto_row["id"]
-            custo_unitario = float(produto_row["custo_unitario"] or 0.0)
-
-            data_venda_raw = row.get("Data da venda")
-            data_venda = parse_data_venda(data_venda_raw)
-            unidades = row.get("Unidades")
-            try:
-                unidades = int(unidades) if unidades == unidades else 0
-            except Exception:
-                unidades = 0
-
-            total_brl = row.get("Total (BRL)")
-            try:
-                receita_total = float(total_brl) if total_brl == total_brl else 0.0
-            except Exception:
-                receita_total = 0.0
-
-            preco_medio_venda = receita_total / unidades if unidades > 0 else 0.0
-            custo_total = custo_unitario * unidades
-            margem_contribuicao = receita_total - custo_total
-            numero_venda_ml = str(row.get("N.º de venda"))
+        catalogo = carregar_catalogo(conn)
+        id_por_sku = catalogo["id_por_sku"]
+        id_por_nome = catalogo["id_por_nome"]
+        custo_por_id = catalogo["custo_por_id"]
+
+        skus = _coluna_texto(df, "SKU")
+        titulos = _coluna_texto(df, "Título do anúncio")
+
+        # com SKU procura pelo SKU; sem SKU tenta pelo nome do produto = título do anúncio
+        tem_sku = skus != ""
+        produto_id = skus.map(id_por_sku).where(
+            tem_sku, titulos.where(titulos != "").map(id_por_nome)
+        )
+        encontrado = produto_id.notna()
 
-            conn.execute(
-                insert(vendas).values(
-                    produto_id=produto_id,
-                    data_venda=data_venda.isoformat() if data_venda else None,
-                    quantidade=unidades,
-                    preco_venda_unitario=preco_medio_venda,
-                    receita_total=receita_total,
-                    custo_total=custo_total,
-                    margem_contribuicao=margem_contribuicao,
-                    origem="Mercado Livre",
-                    numero_venda_ml=numero_venda_ml,
-                    lote_importacao=lote_id,
-                )
-            )
+        vendas_sem_sku = int((~tem_sku & ~encontrado).sum())
+        vendas_sem_produto = int((tem_sku & ~encontrado).sum())
 
-            conn.execute(
-                update(produtos)
-                .where(produtos.c.id == produto_id)
-                .values(estoque_atual=produtos.c.estoque_atual - unidades)
-            )
+        df = df[encontrado]
+        produto_id = produto_id[encontrado].astype(int)
 
-            vendas_importadas += 1
+        unidades = pd.to_numeric(df["Unidades"], errors="coerce").fillna(0).astype(int)
+        receita_total = pd.to_numeric(df["Total (BRL)"], errors="coerce").fillna(0.0)
+        preco_medio_venda = np.where(unidades > 0, receita_total / unidades, 0.0)
+        custo_total = produto_id.map(custo_por_id) * unidades
+        margem_contribuicao = receita_total - custo_total
 
+        datas = parse_data_venda(df["Data da venda"])
+        datas_iso = datas.dt.strftime("%Y-%m-%dT%H:%M:%S").astype(object).where(datas.notna(), None)
+
+        novas_vendas = pd.DataFrame({
+            "produto_id": produto_id,
+            "data_venda": datas_iso,
+            "quantidade": unidades,
+            "preco_venda_unitario": preco_medio_venda,
+            "receita_total": receita_total,
+            "custo_total": custo_total,
+            "margem_contribuicao": margem_contribuicao,
+            "origem": "Mercado Livre",
+            "numero_venda_ml": df["N.º de venda"],
+            "lote_importacao": lote_id,
+        })
+        # a planilha não é mais necessária: libera antes de montar os registros do INSERT
+        del df
+        gravar_vendas(conn, novas_vendas)
 
     return {
         "lote_id": lote_id,
-        "vendas_importadas": vendas_importadas,
+        "vendas_importadas": len(novas_vendas),
         "vendas_sem_sku": vendas_sem_sku,
         "vendas_sem_produto": vendas_sem_produto,
     }
 
 
-def parse_brl(valor):
-    """Converte valores no formato brasileiro (R$ 1.234,56) para float."""
-    if valor is None:
-        return 0.0
-    # Se já for número
-    if isinstance(valor, (int, float)):
-        try:
-            if pd.isna(valor):
-                return 0.0
-        except Exception:
-            pass
-        return float(valor)
-    s = str(valor).strip()
-    if not s:
-        return 0.0
-    s = s.replace("R$", "").replace("\u00a0", "").replace(" ", "")
-    # remove separador de milhar e troca vírgula por ponto
-    s = s.replace(".", "").replace(",", ".")
+def carregar_catalogo(conn):
+    """Mapas sku -> id, nome -> id e id -> custo dos produtos, em cache até a próxima alteração de produtos."""
+    catalogo = cache.get("catalogo_produtos")
+    if catalogo is not None:
+        return catalogo
+
+    linhas = conn.execute(
+        select(produtos.c.id, produtos.c.sku, produtos.c.nome, produtos.c.custo_unitario)
+        .order_by(produtos.c.id)
+    ).all()
+    # chaves normalizadas como as colunas da planilha (_coluna_texto): sem espaços nas pontas
+    id_por_sku = {}
+    id_por_nome = {}
+    for p in linhas:
+        sku = (p.sku or "").strip()
+        if sku:
+            id_por_sku.setdefault(sku, p.id)
+        id_por_nome.setdefault((p.nome or "").strip(), p.id)
+    catalogo = {
+        "id_por_sku": id_por_sku,
+        "id_por_nome": id_por_nome,
+        "custo_por_id": {p.id: float(p.custo_unitario or 0.0) for p in linhas},
+    }
+    cache.set("catalogo_produtos", catalogo)
+    return catalogo
+
+
+def invalidar_catalogo():
+    """Descarta o catálogo em cache após cadastro, edição, exclusão ou troca de custo de produto."""
+    cache.delete("catalogo_produtos")
+
+
+def gravar_vendas(conn, novas_vendas):
+    """Insere as vendas em lote e dá baixa no estoque de todos os produtos do lote num único UPDATE."""
+    if novas_vendas.empty:
+        return
+    if conn.dialect.name == "postgresql" and conn.dialect.driver in ("psycopg2", "psycopg"):
+        _copiar_vendas(conn, novas_vendas)
+    else:
+        conn.execute(INSERT_VENDA, novas_vendas.to_dict(orient="records"))
+
+    baixas = novas_vendas.groupby("produto_id")["quantidade"].sum()
+    pares = [(int(pid), int(qtd)) for pid, qtd in baixas.items()]
+
+    if conn.dialect.name == "postgresql":
+        # um único UPDATE ... FROM (VALUES ...) para todos os produtos do lote
+        d = values(column("id", Integer), column("qtd", Integer), name="d").data(pares)
+        conn.execute(
+            update(produtos)
+            .where(produtos.c.id == d.c.id)
+            .values(estoque_atual=produtos.c.estoque_atual - d.c.qtd)
+        )
+    else:
+        # SQLite: UPDATE ... SET estoque_atual = estoque_atual - CASE id WHEN ... THEN qtd END
+        baixa_por_id = dict(pares)
+        conn.execute(
+            update(produtos)
+            .where(produtos.c.id.in_(baixa_por_id))
+            .values(estoque_atual=produtos.c.estoque_atual - case(baixa_por_id, value=produtos.c.id))
+        )
+
+
+def _copiar_vendas(conn, novas_vendas):
+    """Postgres: grava as vendas com COPY ... FROM STDIN (CSV), na mesma transação de conn."""
+    sql = f"COPY vendas ({', '.join(novas_vendas.columns)}) FROM STDIN WITH (FORMAT csv)"
+    # em CSV, campo vazio sem aspas vira NULL (data inválida, venda sem número do ML)
+    dados = novas_vendas.to_csv(index=False, header=False)
+    cursor = conn.connection.dbapi_connection.cursor()
     try:
-        return float(s)
-    except ValueError:
-        return 0.0
+        if conn.dialect.driver == "psycopg2":
+            cursor.copy_expert(sql, StringIO(dados))
+        else:
+            with cursor.copy(sql) as copia:
+                copia.write(dados)
+    finally:
+        cursor.close()
+
+
+def _coluna_texto(df, nome):
+    """Coluna de texto normalizada (sem NaN e sem espaços nas pontas)."""
+    if nome not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[nome].fillna("").astype(str).str.strip()
+
+
+def parse_brl_series(serie):
+    """Converte uma coluna com valores no formato brasileiro (R$ 1.234,56) para float (vazio/inválido = 0.0)."""
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype(float).fillna(0.0)
+    serie = serie.astype(object)
+    texto = (
+        serie.str.replace("R$", "", regex=False)
+        .str.replace("\u00a0", "", regex=False)
+        .str.replace(" ", "", regex=False)
+        # remove separador de milhar e troca vírgula por ponto
+        .str.replace(".", "", regex=False)
+        .str.replace(",", ".", regex=False)
+    )
+    # células que já vieram como número ficam NaN no .str e são convertidas direto
+    valores = pd.to_numeric(texto, errors="coerce").where(texto.notna(), pd.to_numeric(serie, errors="coerce"))
+    return valores.fillna(0.0).astype(float)
+
+
+# colunas do template consolidado; as demais colunas da planilha são ignoradas na leitura
+COLUNAS_TEMPLATE = {"SKU", "Título", "Quantidade", "Receita", "Comissao", "PrecoMedio"}
 
 
 def importar_vendas_template(caminho_arquivo, engine: Engine):
     """Importa vendas a partir do template consolidado (SKU, Título, Quantidade, Receita, Comissao, PrecoMedio)."""
     lote_id = datetime.now().isoformat(timespec="seconds")
 
-    # tenta ler a aba 'Template'; se não existir, usa a primeira
-    try:
-        df = pd.read_excel(caminho_arquivo, sheet_name="Template")
-    except Exception:
-        df = pd.read_excel(caminho_arquivo, sheet_name=0)
+    # lê a aba 'Template'; se não existir, usa a primeira (o arquivo é aberto uma vez só)
+    with pd.ExcelFile(caminho_arquivo, engine="calamine") as xls:
+        aba = "Template" if "Template" in xls.sheet_names else 0
+        df = xls.parse(aba, usecols=lambda c: c in COLUNAS_TEMPLATE, dtype={"SKU": "string", "Título": "string"})
 
-    colunas_obrig = {"SKU", "Título", "Quantidade", "Receita", "Comissao", "PrecoMedio"}
-    if not colunas_obrig.issubset(set(df.columns)):
+    if not COLUNAS_TEMPLATE.issubset(set(df.columns)):
         raise ValueError("Planilha não está no formato esperado: colunas 'SKU, Título, Quantidade, Receita, Comissao, PrecoMedio' são obrigatórias.")
 
-    vendas_importadas = 0
-    vendas_sem_sku = 0
-    vendas_sem_produto = 0
-
     with engine.begin() as conn:
-        for _, row in df.iterrows():
-            sku = str(row.get("SKU") or "").strip()
-            titulo = str(row.get("Título") or "").strip()
-
-            qtd_raw = row.get("Quantidade")
-            try:
-                quantidade = int(qtd_raw) if qtd_raw == qtd_raw else 0
-            except Exception:
-                quantidade = 0
-
-            if quantidade <= 0:
-                continue
-
-            receita_total = parse_brl(row.get("Receita"))
-            comissao = parse_brl(row.get("Comissao"))
-
-            # Encontrar produto
-            produto_row = None
-            if sku:
-                produto_row = conn.execute(
-                    select(produtos.c.id, produtos.c.custo_unitario)
-                    .where(produtos.c.sku == sku)
-                ).mappings().first()
-            if not produto_row and titulo:
-                produto_row = conn.execute(
-                    select(produtos.c.id, produtos.c.custo_unitario)
-                    .where(produtos.c.nome == titulo)
-                ).mappings().first()
-
-            if not sku and not produto_row:
-                vendas_sem_sku += 1
-                continue
-
-            if not produto_row:
-                vendas_sem_produto += 1
-                continue
-
-            produto_id = produto_row["id"]
-            custo_unitario = float(produto_row["custo_unitario"] or 0.0)
-
-            custo_total = custo_unitario * quantidade
-
-            # margem antes da comissão
-            margem_bruta = receita_total - custo_total
-            # Opção B: reduzir margem pela comissão
-            margem_contribuicao = margem_bruta - comissao
-
-            # Opção 2: ignorar PrecoMedio da planilha, calcular pelo total / quantidade
-            preco_venda_unitario = receita_total / quantidade if quantidade > 0 else 0.0
-
-            conn.execute(
-                insert(vendas).values(
-                    produto_id=produto_id,
-                    data_venda=datetime.now().isoformat(),
-                    quantidade=quantidade,
-                    preco_venda_unitario=preco_venda_unitario,
-                    receita_total=receita_total,
-                    custo_total=custo_total,
-                    margem_contribuicao=margem_contribuicao,
-                    origem="Template",
-                    numero_venda_ml=None,
-                    lote_importacao=lote_id,
-                )
-            )
-
-            conn.execute(
-                update(produtos)
-                .where(produtos.c.id == produto_id)
-                .values(estoque_atual=produtos.c.estoque_atual - quantidade)
-            )
-
-            vendas_importadas += 1
+        catalogo = carregar_catalogo(conn)
+        id_por_sku = catalogo["id_por_sku"]
+        id_por_nome = catalogo["id_por_nome"]
+        custo_por_id = catalogo["custo_por_id"]
+
+        # linhas sem quantidade positiva são ignoradas (não contam como sem SKU/produto)
+        quantidade = pd.to_numeric(df["Quantidade"], errors="coerce").fillna(0).astype(int)
+        df = df[quantidade > 0]
+        quantidade = quantidade[quantidade > 0]
+
+        skus = _coluna_texto(df, "SKU")
+        titulos = _coluna_texto(df, "Título")
+
+        # procura pelo SKU e, se não achar, pelo nome do produto = Título
+        tem_sku = skus != ""
+        produto_id = skus.map(id_por_sku).fillna(titulos.where(titulos != "").map(id_por_nome))
+        encontrado = produto_id.notna()
+
+        vendas_sem_sku = int((~tem_sku & ~encontrado).sum())
+        vendas_sem_produto = int((tem_sku & ~encontrado).sum())
+
+        df = df[encontrado]
+        quantidade = quantidade[encontrado]
+        produto_id = produto_id[encontrado].astype(int)
+
+        receita_total = parse_brl_series(df["Receita"])
+        comissao = parse_brl_series(df["Comissao"])
+        custo_total = produto_id.map(custo_por_id) * quantidade
+
+        # margem antes da comissão
+        margem_bruta = receita_total - custo_total
+        # Opção B: reduzir margem pela comissão
+        margem_contribuicao = margem_bruta - comissao
+
+        # Opção 2: ignorar PrecoMedio da planilha, calcular pelo total / quantidade
+        preco_venda_unitario = receita_total / quantidade
+
+        novas_vendas = pd.DataFrame({
+            "produto_id": produto_id,
+            "data_venda": datetime.now().isoformat(),
+            "quantidade": quantidade,
+            "preco_venda_unitario": preco_venda_unitario,
+            "receita_total": receita_total,
+            "custo_total": custo_total,
+            "margem_contribuicao": margem_contribuicao,
+            "origem": "Template",
+            "numero_venda_ml": None,
+            "lote_importacao": lote_id,
+        })
+        # um INSERT em lote e uma baixa de estoque por produto
+        gravar_vendas(conn, novas_vendas)
 
     return {
         "lote_id": lote_id,
-        "vendas_importadas": vendas_importadas,
+        "vendas_importadas": len(novas_vendas),
         "vendas_sem_sku": vendas_sem_sku,
         "vendas_sem_produto": vendas_sem_produto,
     }
 
+# --------------------------------------------------------------------
+# Paginação das listagens (?page=N&size=M)
+# --------------------------------------------------------------------
+TAMANHO_PAGINA = 100
+TAMANHO_PAGINA_MAX = 500
+
+def ler_paginacao():
+    """Lê página e tamanho da query string, com limites."""
+    pagina = max(request.args.get("page", 1, type=int), 1)
+    tamanho = min(max(request.args.get("size", TAMANHO_PAGINA, type=int), 1), TAMANHO_PAGINA_MAX)
+    return pagina, tamanho
+
+def montar_paginacao(pagina, tamanho, total):
+    """Dados usados pelo bloco templates/paginacao.html."""
+    return {
+        "pagina": pagina,
+        "tamanho": tamanho,
+        "total": total,
+        "total_paginas": max(math.ceil(total / tamanho), 1),
+    }
+
 # --------------------------------------------------------------------
 # Rotas principais
 
 # --------------------------------------------------------------------
 @app.route("/")
 def dashboard():
-    with engine.connect() as conn:
-        total_produtos = conn.execute(
-            select(func.count()).select_from(produtos)
-        ).scalar_one()
-
-        estoque_total = conn.execute(
-            select(func.coalesce(func.sum(produtos.c.estoque_atual), 0))
-        ).scalar_one()
+    return render_template("dashboard.html", **_dashboard_context())
 
-        receita_total = conn.execute(
-            select(func.coalesce(func.sum(vendas.c.receita_total), 0))
-        ).scalar_one()
 
-        lucro_total = conn.execute(
-            select(func.coalesce(func.sum(vendas.c.margem_contribuicao), 0))
-        ).scalar_one()
-
-        margem_media = conn.execute(
+@cache.memoize()
+def _dashboard_context():
+    """Indicadores do dashboard; ficam em cache até a próxima alteração de dados."""
+    with engine.connect() as conn:
+        # todos os indicadores escalares num único SELECT
+        resumo = conn.execute(
             select(
+                select(func.count()).select_from(produtos).scalar_subquery().label("total_produtos"),
+                select(func.coalesce(func.sum(produtos.c.estoque_atual), 0))
+                .scalar_subquery().label("estoque_total"),
+                func.coalesce(func.sum(vendas.c.receita_total), 0).label("receita_total"),
+                func.coalesce(func.sum(vendas.c.margem_contribuicao), 0).label("lucro_total"),
                 func.coalesce(
                     func.avg(
                         func.nullif(
@@ -375,61 +501,104 @@ def dashboard():
                         )
                     ),
                     0
-                )
-            )
-        ).scalar_one()
-
-        ticket_medio = conn.execute(
-            select(func.coalesce(func.avg(vendas.c.preco_venda_unitario), 0))
-        ).scalar_one()
+                ).label("margem_media"),
+                func.coalesce(func.avg(vendas.c.preco_venda_unitario), 0).label("ticket_medio"),
+            ).select_from(vendas)
+        ).mappings().one()
 
-        produto_mais_vendido = conn.execute(
-            select(produtos.c.nome, func.sum(vendas.c.quantidade).label("qtd"))
+        # um agrupamento por produto serve aos três rankings; o banco devolve só os vencedores
+        por_produto = (
+            select(
+                produtos.c.id,
+                produtos.c.nome,
+                func.sum(vendas.c.quantidade).label("qtd"),
+                func.sum(vendas.c.margem_contribuicao).label("lucro"),
+            )
             .select_from(vendas.join(produtos))
             .group_by(produtos.c.id)
-            .order_by(func.sum(vendas.c.quantidade).desc())
-            .limit(1)
-        ).first()
+            .cte("por_produto")
+        )
+        ranking = select(
+            por_produto.c.nome,
+            por_produto.c.qtd,
+            por_produto.c.lucro,
+            func.row_number().over(order_by=(por_produto.c.qtd.desc(), por_produto.c.id)).label("pos_qtd"),
+            func.row_number().over(order_by=(por_produto.c.lucro.desc(), por_produto.c.id)).label("pos_maior"),
+            func.row_number().over(order_by=(por_produto.c.lucro.asc(), por_produto.c.id)).label("pos_pior"),
+        ).subquery()
+        vencedores = conn.execute(
+            select(ranking).where(
+                or_(ranking.c.pos_qtd == 1, ranking.c.pos_maior == 1, ranking.c.pos_pior == 1)
+            )
+        ).all()
 
-        produto_maior_lucro = conn.execute(
-            select(produtos.c.nome, func.sum(vendas.c.margem_contribuicao).label("lucro"))
-            .select_from(vendas.join(produtos))
-            .group_by(produtos.c.id)
-            .order_by(func.sum(vendas.c.margem_contribuicao).desc())
-            .limit(1)
-        ).first()
+    produto_mais_vendido = produto_maior_lucro = produto_pior_margem = None
+    for p in vencedores:
+        if p.pos_qtd == 1:
+            produto_mais_vendido = (p.nome, p.qtd)
+        if p.pos_maior == 1:
+            produto_maior_lucro = (p.nome, p.lucro)
+        if p.pos_pior == 1:
+            produto_pior_margem = (p.nome, p.lucro)
 
-        produto_pior_margem = conn.execute(
-            select(produtos.c.nome, func.sum(vendas.c.margem_contribuicao).label("margem"))
-            .select_from(vendas.join(produtos))
-            .group_by(produtos.c.id)
-            .order_by(func.sum(vendas.c.margem_contribuicao).asc())
-            .limit(1)
-        ).first()
+    return {
+        **resumo,
+        "comissao_total": 0,
+        "produto_mais_vendido": produto_mais_vendido,
+        "produto_maior_lucro": produto_maior_lucro,
+        "produto_pior_margem": produto_pior_margem,
+        "cfg": carregar_configuracoes(),
+    }
 
-        cfg = conn.execute(select(configuracoes).where(configuracoes.c.id == 1)).mappings().first()
-
-    return render_template(
-        "dashboard.html",
-        total_produtos=total_produtos,
-        estoque_total=estoque_total,
-        receita_total=receita_total,
-        lucro_total=lucro_total,
-        margem_media=margem_media,
-        ticket_medio=ticket_medio,
-        comissao_total=0,
-        produto_mais_vendido=produto_mais_vendido,
-        produto_maior_lucro=produto_maior_lucro,
-        produto_pior_margem=produto_pior_margem,
-        cfg=cfg,
-    )
+
+def invalidar_indicadores():
+    """Descarta os indicadores em cache (dashboard e relatório de lucro) após qualquer alteração de dados."""
+    cache.delete_memoized(_dashboard_context)
+    cache.delete_memoized(_relatorio_lucro_dados)
+    cache.set("versao_dados", uuid.uuid4().hex, timeout=0)
+
+
+def versao_dados():
+    """Marca que muda a cada alteração de dados; base do ETag das páginas."""
+    versao = cache.get("versao_dados")
+    if versao is None:
+        versao = uuid.uuid4().hex
+        cache.set("versao_dados", versao, timeout=0)
+    return versao
+
+
+def resposta_com_etag(partes, gerar_html):
+    """Responde 304 se o navegador já tem a página desta versão dos dados; senão renderiza com ETag."""
+    # mensagens flash pendentes entram no HTML: essa resposta não pode ser reaproveitada
+    if "_flashes" in session:
+        return gerar_html()
+    etag = "-".join(str(p) for p in (versao_dados(), *partes))
+    if etag in request.if_none_match:
+        resposta = Response(status=304)
+    else:
+        resposta = make_response(gerar_html())
+    resposta.set_etag(etag)
+    resposta.headers["Cache-Control"] = "no-cache"
+    return resposta
 
 # ---------------- PRODUTOS ----------------
 @app.route("/produtos")
 def lista_produtos():
-    with engine.connect() as conn:
-        produtos_rows = conn.execute(select(produtos).order_by(produtos.c.nome)).mappings().all()
-    return render_template("produtos.html", produtos=produtos_rows)
+    pagina, tamanho = ler_paginacao()
+
+    def gerar_html():
+        with engine.connect() as conn:
+            total = conn.execute(select(func.count()).select_from(produtos)).scalar_one()
+            produtos_rows = conn.execute(
+                select(produtos)
+                .order_by(produtos.c.nome, produtos.c.id)
+                .limit(tamanho)
+                .offset((pagina - 1) * tamanho)
+            ).mappings().all()
+        return render_template("produtos.html", produtos=produtos_rows,
+                               paginacao=montar_paginacao(pagina, tamanho, total))
+
+    return resposta_com_etag((pagina, tamanho), gerar_html)
 
 @app.route("/produtos/novo", methods=["GET", "POST"])
 def novo_produto():
@@ -451,6 +620,8 @@ def novo_produto():
                     estoque_atual=estoque_inicial,
                 )
             )
+        invalidar_catalogo()
+        invalidar_indicadores()
         flash("Produto cadastrado com sucesso!", "success")
         return redirect(url_for("lista_produtos"))
 
@@ -477,6 +648,8 @@ def editar_produto(produto_id):
                     estoque_atual=estoque_atual,
                 )
             )
+        invalidar_catalogo()
+        invalidar_indicadores()
         flash("Produto atualizado!", "success")
         return redirect(url_for("lista_produtos"))
 
@@ -495,46 +668,60 @@ def editar_produto(produto_id):
 def excluir_produto(produto_id):
     with engine.begin() as conn:
         conn.execute(delete(produtos).where(produtos.c.id == produto_id))
+    invalidar_catalogo()
+    invalidar_indicadores()
     flash("Produto excluído.", "success")
     return redirect(url_for("lista_produtos"))
 
 # ---------------- VENDAS ----------------
 @app.route("/vendas")
 def lista_vendas():
-    with engine.connect() as conn:
-        vendas_rows = conn.execute(
-            select(
-                vendas.c.id,
-                vendas.c.data_venda,
-                vendas.c.quantidade,
-                vendas.c.preco_venda_unitario,
-                vendas.c.receita_total,
-                vendas.c.margem_contribuicao,
-                vendas.c.origem,
-                vendas.c.numero_venda_ml,
-                vendas.c.lote_importacao,
-                produtos.c.nome,
-            )
-            .select_from(vendas.join(produtos))
-            .order_by(vendas.c.data_venda.desc(), vendas.c.id.desc())
-        ).mappings().all()
+    pagina, tamanho = ler_paginacao()
+
+    def gerar_html():
+        with engine.connect() as conn:
+            total = conn.execute(
+                select(func.count()).select_from(vendas.join(produtos))
+            ).scalar_one()
+
+            vendas_rows = conn.execute(
+                select(
+                    vendas.c.id,
+                    vendas.c.data_venda,
+                    vendas.c.quantidade,
+                    vendas.c.preco_venda_unitario,
+                    vendas.c.receita_total,
+                    vendas.c.margem_contribuicao,
+                    vendas.c.origem,
+                    vendas.c.numero_venda_ml,
+                    vendas.c.lote_importacao,
+                    produtos.c.nome,
+                )
+                .select_from(vendas.join(produtos))
+                .order_by(vendas.c.data_venda.desc(), vendas.c.id.desc())
+                .limit(tamanho)
+                .offset((pagina - 1) * tamanho)
+            ).mappings().all()
+
+            lotes = conn.execute(
+                select(
+                    vendas.c.lote_importacao.label("lote_importacao"),
+                    func.count().label("qtd_vendas"),
+                    func.coalesce(func.sum(vendas.c.receita_total), 0).label("receita_lote"),
+                )
+                .where(vendas.c.lote_importacao.isnot(None))
+                .group_by(vendas.c.lote_importacao)
+                .order_by(vendas.c.lote_importacao.desc())
+            ).mappings().all()
 
-        lotes = conn.execute(
-            select(
-                vendas.c.lote_importacao.label("lote_importacao"),
-                func.count().label("qtd_vendas"),
-                func.coalesce(func.sum(vendas.c.receita_total), 0).label("receita_lote"),
-            )
-            .where(vendas.c.lote_importacao.isnot(None))
-            .group_by(vendas.c.lote_importacao)
-            .order_by(vendas.c.lote_importacao.desc())
-        ).mappings().all()
+            produtos_rows = conn.execute(
+                select(produtos.c.id, produtos.c.nome).order_by(produtos.c.nome)
+            ).mappings().all()
 
-        produtos_rows = conn.execute(
-            select(produtos.c.id, produtos.c.nome).order_by(produtos.c.nome)
-        ).mappings().all()
+        return render_template("vendas.html", vendas=vendas_rows, lotes=lotes, produtos=produtos_rows,
+                               paginacao=montar_paginacao(pagina, tamanho, total))
 
-    return render_template("vendas.html", vendas=vendas_rows, lotes=lotes, produtos=produtos_rows)
+    return resposta_com_etag((pagina, tamanho), gerar_html)
 
 @app.route("/vendas/manual", methods=["POST"])
 def criar_venda_manual():
@@ -574,6 +761,7 @@ def criar_venda_manual():
             .values(estoque_atual=produtos.c.estoque_atual - quantidade)
         )
 
+    invalidar_indicadores()
     flash("Venda manual registrada com sucesso!", "success")
     return redirect(url_for("lista_vendas"))
 
@@ -598,6 +786,7 @@ def editar_venda(venda_id):
                     margem_contribuicao=margem_contribuicao,
                 )
             )
+        invalidar_indicadores()
         flash("Venda atualizada com sucesso!", "success")
         return redirect(url_for("lista_vendas"))
 
@@ -625,6 +814,7 @@ def editar_venda(venda_id):
 def excluir_venda(venda_id):
     with engine.begin() as conn:
         conn.execute(delete(vendas).where(vendas.c.id == venda_id))
+    invalidar_indicadores()
     flash("Venda excluída com sucesso!", "success")
     return redirect(url_for("lista_vendas"))
 
@@ -632,10 +822,48 @@ def excluir_venda(venda_id):
 def excluir_lote_vendas(lote_id):
     with engine.begin() as conn:
         conn.execute(delete(vendas).where(vendas.c.lote_importacao == lote_id))
+    invalidar_indicadores()
     flash("Lote de importação excluído com sucesso!", "success")
     return redirect(url_for("lista_vendas"))
 
 # ---------------- IMPORT / EXPORT ----------------
+# As importações (Mercado Livre e template) rodam em segundo plano para não prender o worker HTTP.
+# O andamento fica em memória deste processo (só as últimas MAX_IMPORTACOES) e
+# /importar_ml/status/<job_id> consulta qualquer uma delas.
+MAX_IMPORTACOES = 20
+executor_importacao = ThreadPoolExecutor(max_workers=2)
+importacoes = {}
+
+
+def iniciar_importacao(funcao, caminho, arquivo, tipo):
+    """Agenda funcao(caminho, engine) no executor e devolve o id do job."""
+    job = {
+        "id": uuid.uuid4().hex,
+        "tipo": tipo,
+        "arquivo": arquivo,
+        "inicio": datetime.now().isoformat(timespec="seconds"),
+        "status": "processando",
+        "resumo": None,
+        "erro": None,
+    }
+    importacoes[job["id"]] = job
+    while len(importacoes) > MAX_IMPORTACOES:
+        importacoes.pop(next(iter(importacoes)))
+    executor_importacao.submit(_executar_importacao, job, funcao, caminho)
+    return job["id"]
+
+
+def _executar_importacao(job, funcao, caminho):
+    try:
+        job["resumo"] = funcao(caminho, engine)
+        with app.app_context():
+            invalidar_indicadores()
+        job["status"] = "concluida"
+    except Exception as e:
+        job["erro"] = str(e)
+        job["status"] = "erro"
+
+
 @app.route("/importar_ml", methods=["GET", "POST"])
 def importar_ml_view():
     if request.method == "POST":
@@ -647,23 +875,23 @@ def importar_ml_view():
             flash("Selecione um arquivo.", "danger")
             return redirect(request.url)
         filename = secure_filename(file.filename)
-        caminho = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+        # prefixo único: dois envios com o mesmo nome não se sobrescrevem enquanto processam
+        caminho = os.path.join(app.config["UPLOAD_FOLDER"], f"{uuid.uuid4().hex[:8]}_{filename}")
         file.save(caminho)
 
-        try:
-            resumo = importar_vendas_ml(caminho, engine)
-            flash(
-                f"Importação concluída. Lote {resumo['lote_id']} - "
-                f"{resumo['vendas_importadas']} vendas importadas, "
-                f"{resumo['vendas_sem_sku']} sem SKU/Título, "
-                f"{resumo['vendas_sem_produto']} sem produto cadastrado.",
-                "success",
-            )
-        except Exception as e:
-            flash(f"Erro na importação: {e}", "danger")
+        iniciar_importacao(importar_vendas_ml, caminho, filename, "Mercado Livre")
+        flash("Arquivo recebido. A importação está em andamento; acompanhe abaixo.", "success")
         return redirect(url_for("importar_ml_view"))
 
-    return render_template("importar_ml.html")
+    return render_template("importar_ml.html", importacoes=list(reversed(importacoes.values())))
+
+
+@app.route("/importar_ml/status/<job_id>")
+def status_importacao(job_id):
+    job = importacoes.get(job_id)
+    if not job:
+        return jsonify({"erro": "Importação não encontrada."}), 404
+    return jsonify(job)
 
 
 @app.route("/importar_template", methods=["POST"])
@@ -677,48 +905,46 @@ def importar_template():
         flash("Selecione um arquivo para o template.", "danger")
         return redirect(url_for("importar_ml_view"))
     filename = secure_filename(file.filename)
-    caminho = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    caminho = os.path.join(app.config["UPLOAD_FOLDER"], f"{uuid.uuid4().hex[:8]}_{filename}")
     file.save(caminho)
 
-    try:
-        resumo = importar_vendas_template(caminho, engine)
-        flash(
-            f"Template importado. Lote {resumo['lote_id']} - "
-            f"{resumo['vendas_importadas']} vendas importadas, "
-            f"{resumo['vendas_sem_sku']} linhas sem SKU/Título, "
-            f"{resumo['vendas_sem_produto']} sem produto cadastrado.",
-            "success",
-        )
-    except Exception as e:
-        flash(f"Erro na importação pelo template: {e}", "danger")
+    iniciar_importacao(importar_vendas_template, caminho, filename, "Template")
+    flash("Template recebido. A importação está em andamento; acompanhe abaixo.", "success")
     return redirect(url_for("importar_ml_view"))
 
 
+CONSULTA_CONSOLIDADO = (
+    select(
+        vendas.c.id.label("ID Venda"),
+        vendas.c.data_venda.label("Data venda"),
+        produtos.c.nome.label("Produto"),
+        produtos.c.sku.label("SKU"),
+        vendas.c.quantidade.label("Quantidade"),
+        vendas.c.preco_venda_unitario.label("Preço unitário"),
+        vendas.c.receita_total.label("Receita total"),
+        vendas.c.custo_total.label("Custo total"),
+        vendas.c.margem_contribuicao.label("Margem contribuição"),
+        vendas.c.origem.label("Origem"),
+        vendas.c.numero_venda_ml.label("Nº venda ML"),
+        vendas.c.lote_importacao.label("Lote importação"),
+    ).select_from(vendas.join(produtos))
+)
+
+
 @app.route("/exportar_consolidado")
 def exportar_consolidado():
     """Exporta planilha de consolidação das vendas."""
-    with engine.connect() as conn:
-        rows = conn.execute(
-            select(
-                vendas.c.id.label("ID Venda"),
-                vendas.c.data_venda.label("Data venda"),
-                produtos.c.nome.label("Produto"),
-                produtos.c.sku.label("SKU"),
-                vendas.c.quantidade.label("Quantidade"),
-                vendas.c.preco_venda_unitario.label("Preço unitário"),
-                vendas.c.receita_total.label("Receita total"),
-                vendas.c.custo_total.label("Custo total"),
-                vendas.c.margem_contribuicao.label("Margem contribuição"),
-                vendas.c.origem.label("Origem"),
-                vendas.c.numero_venda_ml.label("Nº venda ML"),
-                vendas.c.lote_importacao.label("Lote importação"),
-            ).select_from(vendas.join(produtos))
-        ).mappings().all()
-
-    df = pd.DataFrame(rows)
+    # lê em blocos (cursor do lado do servidor no Postgres) e escreve linha a linha;
+    # com constant_memory o xlsxwriter descarrega cada linha já escrita
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Consolidado")
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True})
+    ws = wb.add_worksheet("Consolidado")
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=1000).execute(CONSULTA_CONSOLIDADO)
+        ws.write_row(0, 0, list(result.keys()))
+        for i, row in enumerate(result, start=1):
+            ws.write_row(i, 0, row)
+    wb.close()
     output.seek(0)
 
     return send_file(
@@ -730,13 +956,30 @@ def exportar_consolidado():
 
 
 
+@app.route("/exportar_consolidado.csv")
+def exportar_consolidado_csv():
+    """Exporta a consolidação das vendas em CSV, gerado em blocos durante o envio."""
+    def gerar():
+        # read_sql monta cada bloco direto em colunas tipadas, sem passar por linhas Python
+        with engine.connect() as conn:
+            blocos = pd.read_sql(CONSULTA_CONSOLIDADO, conn.execution_options(stream_results=True), chunksize=10_000)
+            for i, bloco in enumerate(blocos):
+                yield bloco.to_csv(index=False, header=(i == 0))
+
+    return Response(
+        gerar(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=consolidado_vendas_{datetime.now().date()}.csv"},
+    )
+
+
 @app.route("/exportar_template")
 def exportar_template():
     """Exporta o modelo de planilha para preenchimento manual (SKU, Título, Quantidade, Receita, Comissao, PrecoMedio)."""
     cols = ["SKU", "Título", "Quantidade", "Receita", "Comissao", "PrecoMedio"]
     df = pd.DataFrame(columns=cols)
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
         df.to_excel(writer, index=False, sheet_name="Template")
     output.seek(0)
     return send_file(
@@ -798,10 +1041,32 @@ def ajuste_estoque():
             )
         )
 
+    invalidar_catalogo()
+    invalidar_indicadores()
     flash("Ajuste de estoque registrado!", "success")
     return redirect(url_for("estoque_view"))
 
 # ---------------- CONFIGURAÇÕES ----------------
+def carregar_configuracoes():
+    """Linha única de configuracoes como dict, em cache até ser salva de novo (None se não existir)."""
+    cfg = cache.get("configuracoes")
+    if cfg is None:
+        with engine.connect() as conn:
+            linha = conn.execute(
+                select(configuracoes).where(configuracoes.c.id == 1)
+            ).mappings().first()
+        if linha is None:
+            return None
+        cfg = dict(linha)
+        cache.set("configuracoes", cfg)
+    return cfg
+
+
+def guardar_configuracoes(cfg):
+    """Atualiza as configurações em cache com os valores recém-salvos (sem reler do banco)."""
+    cache.set("configuracoes", cfg)
+
+
 @app.route("/configuracoes", methods=["GET", "POST"])
 def configuracoes_view():
     if request.method == "POST":
@@ -813,86 +1078,78 @@ def configuracoes_view():
                 .where(configuracoes.c.id == 1)
                 .values(imposto_percent=imposto_percent, despesas_percent=despesas_percent)
             )
+        guardar_configuracoes(
+            {"id": 1, "imposto_percent": imposto_percent, "despesas_percent": despesas_percent}
+        )
+        invalidar_indicadores()
         flash("Configurações salvas!", "success")
         return redirect(url_for("configuracoes_view"))
 
-    with engine.connect() as conn:
-        cfg = conn.execute(
-            select(configuracoes).where(configuracoes.c.id == 1)
-        ).mappings().first()
-
-    return render_template("configuracoes.html", cfg=cfg)
+    return render_template("configuracoes.html", cfg=carregar_configuracoes())
 
 # ---------------- RELATÓRIO LUCRO ----------------
 
-@app.route("/relatorio_lucro")
-def relatorio_lucro():
-    with engine.connect() as conn:
-        linhas_db = conn.execute(
-            select(
-                produtos.c.nome,
-                func.sum(vendas.c.quantidade).label("qtd"),
-                func.sum(vendas.c.receita_total).label("receita"),
-                func.sum(vendas.c.custo_total).label("custo"),
-                func.sum(vendas.c.margem_contribuicao).label("margem"),
-            )
-            .select_from(vendas.join(produtos))
-            .group_by(produtos.c.id)
-            .order_by(func.sum(vendas.c.margem_contribuicao).desc())
-        ).mappings().all()
+def _colunas_lucro():
+    """Agregados do relatório de lucro; impostos, despesas e lucro líquido já calculados no SELECT."""
+    receita = func.coalesce(func.sum(vendas.c.receita_total), 0)
+    margem = func.coalesce(func.sum(vendas.c.margem_contribuicao), 0)
+    impostos = receita * bindparam("imposto_percent", type_=Float) / 100.0
+    despesas = receita * bindparam("despesas_percent", type_=Float) / 100.0
+    return [
+        func.coalesce(func.sum(vendas.c.quantidade), 0).label("qtd"),
+        receita.label("receita"),
+        func.coalesce(func.sum(vendas.c.custo_total), 0).label("custo"),
+        margem.label("margem"),
+        impostos.label("impostos"),
+        despesas.label("despesas"),
+        (margem - impostos - despesas).label("lucro_liquido"),
+    ]
+
+
+# Consultas do relatório: montadas uma vez, percentuais e página entram como parâmetros
+CONSULTA_LUCRO_POR_PRODUTO = (
+    select(produtos.c.nome, *_colunas_lucro())
+    .select_from(vendas.join(produtos))
+    .group_by(produtos.c.id)
+    .order_by(desc("margem"), produtos.c.id)
+    .limit(bindparam("limite"))
+    .offset(bindparam("inicio"))
+)
+# mesma conta sem agrupar: a linha de totais (de todos os produtos, não só da página)
+CONSULTA_LUCRO_TOTAIS = (
+    select(*_colunas_lucro(), func.count(func.distinct(vendas.c.produto_id)).label("produtos"))
+    .select_from(vendas.join(produtos))
+)
 
-        cfg = conn.execute(
-            select(configuracoes).where(configuracoes.c.id == 1)
-        ).mappings().first()
 
+@app.route("/relatorio_lucro")
+def relatorio_lucro():
+    cfg = carregar_configuracoes()
     imposto_percent = float(cfg["imposto_percent"] or 0) if cfg else 0.0
     despesas_percent = float(cfg["despesas_percent"] or 0) if cfg else 0.0
+    pagina, tamanho = ler_paginacao()
 
-    linhas = []
-    total_qtd = total_receita = total_custo = total_margem = 0.0
-    total_impostos = total_despesas = total_lucro_liquido = 0.0
-
-    for row in linhas_db:
-        receita = float(row["receita"] or 0)
-        custo = float(row["custo"] or 0)
-        margem = float(row["margem"] or 0)
-        qtd = int(row["qtd"] or 0)
-
-        impostos = receita * imposto_percent / 100.0
-        despesas = receita * despesas_percent / 100.0
-        lucro_liquido = margem - impostos - despesas
-
-        linhas.append({
-            "nome": row["nome"],
-            "qtd": qtd,
-            "receita": receita,
-            "custo": custo,
-            "margem": margem,
-            "impostos": impostos,
-            "despesas": despesas,
-            "lucro_liquido": lucro_liquido,
-        })
+    def gerar_html():
+        linhas, totais = _relatorio_lucro_dados(imposto_percent, despesas_percent, pagina, tamanho)
+        return render_template("relatorio_lucro.html", linhas=linhas, totais=totais,
+                               imposto_percent=imposto_percent, despesas_percent=despesas_percent,
+                               paginacao=montar_paginacao(pagina, tamanho, totais.produtos))
 
-        total_qtd += qtd
-        total_receita += receita
-        total_custo += custo
-        total_margem += margem
-        total_impostos += impostos
-        total_despesas += despesas
-        total_lucro_liquido += lucro_liquido
-
-    totais = {
-        "qtd": total_qtd,
-        "receita": total_receita,
-        "custo": total_custo,
-        "margem": total_margem,
-        "impostos": total_impostos,
-        "despesas": total_despesas,
-        "lucro_liquido": total_lucro_liquido,
-    }
+    return resposta_com_etag((imposto_percent, despesas_percent, pagina, tamanho), gerar_html)
+
+
+@cache.memoize()
+def _relatorio_lucro_dados(imposto_percent, despesas_percent, pagina, tamanho):
+    """Uma página de linhas por produto e os totais gerais; ficam em cache até a próxima alteração de dados."""
+    params = {"imposto_percent": imposto_percent, "despesas_percent": despesas_percent}
+    with engine.connect() as conn:
+        linhas = conn.execute(
+            CONSULTA_LUCRO_POR_PRODUTO, {**params, "limite": tamanho, "inicio": (pagina - 1) * tamanho}
+        ).all()
+        totais = conn.execute(CONSULTA_LUCRO_TOTAIS, params).one()
 
-    return render_template("relatorio_lucro.html", linhas=linhas, totais=totais,
-                           imposto_percent=imposto_percent, despesas_percent=despesas_percent)
+    # Row já é uma tupla nomeada (e serializável para o cache): vai direto para o template
+    return linhas, totais
 
 
 if __name__ == "__main__":